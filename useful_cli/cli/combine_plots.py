@@ -1,11 +1,13 @@
+import os
 import sys
-import cv2
-import numpy as np
 import argparse
-import matplotlib.pyplot as plt 
+import functools
+import imagesize
+from concurrent.futures import ThreadPoolExecutor
 from useful_cli import utils
 
-def initialize():
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     parser = argparse.ArgumentParser(
         description='This script combines multiple figures into a single figure.')
     parser.add_argument('-f',
@@ -37,23 +39,66 @@ def initialize():
                         '--figname',
                         default='combined_figure.png',
                         help='The path to save the combined figure.')
+    parser.add_argument('-l',
+                        '--layout_only',
+                        default=False,
+                        action='store_true',
+                        help='Whether to only print the subplot layout and the sizes of the figures \
+                            (read from the file headers) without decoding or combining the figures.')
+
+    return parser
 
-    args_parse = parser.parse_args()
+
+def initialize(args=None):
+    args_parse = _build_parser().parse_args(args)
 
     return args_parse
 
 
+def read_image(fig_path, max_side=None):
+    """
+    Reads an image file and returns it in RGB channel order. Since OpenCV decodes images in
+    BGR order, the channels are reversed through a view rather than a copy.
+
+    Parameters
+    ----------
+    fig_path : str
+        The path to the image file.
+    max_side : int, optional
+        The number of pixels the longest side of the image needs in the combined figure.
+        Images more than twice as large are downsampled to this size before being plotted.
+        Images at least twice as large are also decoded at a reduced resolution (1/2, 1/4 or 1/8)
+        in the first place, which libjpeg can do at a fraction of the cost of a full decode.
+
+    Returns
+    -------
+    image_rgb : np.ndarray
+        The decoded image in RGB channel order.
+    """
+    import cv2
+
+    flag = cv2.IMREAD_COLOR
+    if max_side is not None:
+        scale = max(imagesize.get(fig_path)) / max_side  # only reads the file header
+        if scale >= 8:
+            flag = cv2.IMREAD_REDUCED_COLOR_8
+        elif scale >= 4:
+            flag = cv2.IMREAD_REDUCED_COLOR_4
+        elif scale >= 2:
+            flag = cv2.IMREAD_REDUCED_COLOR_2
+
+    image = cv2.imread(fig_path, flag)
+    if max_side is not None and max(image.shape[:2]) > 2 * max_side:
+        scale = max_side / max(image.shape[:2])
+        new_size = (max(1, int(image.shape[1] * scale)), max(1, int(image.shape[0] * scale)))
+        image = cv2.resize(image, new_size, interpolation=cv2.INTER_AREA)
+    image_rgb = image[:, :, ::-1]
+
+    return image_rgb
+
+
 def main():
     args = initialize()
-    utils.configure_matplotlib()
-
-    if args.size is None:
-        fig = plt.figure()
-    else:
-        if len(args.size) != 2:
-            print('Warning: wrong number of arguments for specifying the figure size.')
-        else:
-            fig = plt.figure(figsize=tuple(args.size))
 
     if args.dimension is None:
         n_cols, n_rows = utils.get_subplot_layout(len(args.figs))
@@ -68,11 +113,47 @@ def main():
         if len(args.figs) != len(args.titles):
             raise ValueError('The number of titles should match the number of figures.')
 
-    for i in range(len(args.figs)):
-        image = cv2.imread(args.figs[i], cv2.IMREAD_COLOR)
-        image_rgb = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    if args.layout_only:
+        print(f'Subplot layout (n_cols, n_rows): ({n_cols}, {n_rows})')
+        for fig_path in args.figs:
+            width, height = imagesize.get(fig_path)
+            print(f'{fig_path}: {width} x {height} pixels')
+        return
+
+    # matplotlib (and cv2 in read_image) are imported only when the figures are actually combined,
+    # so that --help and --layout_only stay fast.
+    import matplotlib
+    matplotlib.use('Agg')  # the figure is only saved, so no interactive backend is needed
+    import matplotlib.pyplot as plt
+    utils.configure_matplotlib()
+    min_dpi, max_dpi = 150, 300  # the lower bound keeps the titles and borders legible for small inputs
+
+    if args.size is None:
+        fig = plt.figure()
+    else:
+        if len(args.size) != 2:
+            print('Warning: wrong number of arguments for specifying the figure size.')
+        else:
+            fig = plt.figure(figsize=tuple(args.size))
+
+    # Each subplot spans at most 1/n_cols of the figure width and 1/n_rows of its height in the saved
+    # figure, so the longest side of an image never needs more pixels than the longer of the two at max_dpi.
+    subplot_w = fig.get_size_inches()[0] / n_cols
+    subplot_h = fig.get_size_inches()[1] / n_rows
+    max_side = int(max(subplot_w, subplot_h) * max_dpi)
+
+    # OpenCV releases the GIL while decoding, so the images can be read concurrently.
+    with ThreadPoolExecutor(max_workers=min(len(args.figs), os.cpu_count() or 1)) as executor:
+        images = list(executor.map(functools.partial(read_image, max_side=max_side), args.figs))
+
+    # The inputs are already rasters, so the DPI is chosen such that the largest input is reproduced
+    # at about 1:1 pixels in its subplot (within [min_dpi, max_dpi]) rather than resampled onto a denser grid.
+    dpi = max(max(img.shape[1] / subplot_w, img.shape[0] / subplot_h) for img in images)
+    dpi = min(max_dpi, max(min_dpi, dpi))
+
+    for i, image_rgb in enumerate(images):
         fig.add_subplot(n_rows, n_cols, i + 1)
-        plt.imshow(image_rgb)
+        plt.imshow(image_rgb, interpolation='none', rasterized=True)
         if args.border is True:
             plt.xticks([])
             plt.yticks([])
@@ -81,5 +162,10 @@ def main():
         if args.titles is not None:
             plt.title(args.titles[i])
         
-    plt.tight_layout(rect=[0, 0, 1, 1])
-    plt.savefig(f'{args.figname}', dpi=600)
+    if args.titles is None:
+        # Without titles or tick labels there is nothing for tight_layout to measure,
+        # so the extra draw it triggers can be skipped by setting the margins directly.
+        plt.subplots_adjust(wspace=0.02, hspace=0.02, left=0.01, right=0.99, top=0.99, bottom=0.01)
+    else:
+        plt.tight_layout(rect=[0, 0, 1, 1])
+    utils.save_figure(fig, args.figname, dpi)
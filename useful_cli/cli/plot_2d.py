@@ -1,11 +1,18 @@
+import re
 import natsort
 import argparse
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 from useful_cli import utils
 
 
-def initialize():
+# Splits an axis label like "Time (ns)" or "Energy ($k_BT$)" into the variable and the unit
+_LABEL_RE = re.compile(r'^(.*?)\s*(?:\((?:\$([^$]+)\$|([^)]+))\))?\s*$')
+
+
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     conversion_choices = list(utils.get_conversions().keys())
     parser = argparse.ArgumentParser(
         description="Plot 2D data from an XVG files."
@@ -103,8 +110,21 @@ def initialize():
         default=1,
         help='The number of columns of the legend.'
     )
-    
-    args_parse = parser.parse_args()
+    parser.add_argument(
+        '-nc',
+        '--no_cache',
+        default=False,
+        action='store_true',
+        help='Whether to disable caching the parsed data of each XVG file in a sidecar NPZ file \
+            ({xvg}.c{column}.npz), which is loaded instead of the XVG file as long as the size and the \
+            modification time of the XVG file are unchanged.'
+    )
+
+    return parser
+
+
+def initialize(args=None):
+    args_parse = _build_parser().parse_args(args)
 
     if args_parse.legend is None:
         args_parse.legend = args_parse.xvg
@@ -112,82 +132,73 @@ def initialize():
     return args_parse
 
 
+def parse_label(label):
+    """
+    Parses the name of the variable and its unit from an axis label.
+
+    Parameters
+    ----------
+    label : str or None
+        The axis label, e.g. "Time (ns)" or "Energy ($k_BT$)".
+
+    Returns
+    -------
+    var : str or None
+        The name of the variable in lower case, e.g. "time". None if no label is given.
+    unit : str
+        The unit of the variable, e.g. "ns". An empty string if the label does not specify a unit.
+    """
+    if label is None:
+        return None, ''
+    m = _LABEL_RE.match(label)
+
+    return m.group(1).lower().strip(), m.group(2) or m.group(3) or ''
+
+
 def main():
     args = initialize()
+    import matplotlib
+    matplotlib.use('Agg')  # the figure is only saved, so no interactive backend is needed
+    import matplotlib.pyplot as plt
     utils.configure_matplotlib()
     args.xvg = natsort.natsorted(args.xvg)
 
-    plt.figure()  # ready to plot!
-    for i in range(len(args.xvg)):
-        print(f'Analyzing the file: {args.xvg[i]} ...')
+    # The files are read and parsed concurrently, while the plotting below stays on the main thread.
+    with ThreadPoolExecutor(max_workers=min(len(args.xvg), 8)) as executor:
+        read_xvg = functools.partial(utils.read_xvg, column=args.column, cache=not args.no_cache)
+        data = list(executor.map(read_xvg, args.xvg))
 
-        x, y = [], []
-        file = open(args.xvg[i], 'r')
-        lines = file.readlines()
-        file.close()
+    x_var, x_label_unit = parse_label(args.xlabel)
+    y_var, y_label_unit = parse_label(args.ylabel)
 
-        m = 0
-        for line in lines:
-            if line.startswith('#') or line.startswith('@'):
-                m += 1  # number of parameter lines
+    fig = plt.figure()  # ready to plot!
+    for i, (x, y) in enumerate(data):
+        print(f'Analyzing the file: {args.xvg[i]} ...')
+
+        with open(args.xvg[i], 'r') as file:
+            for line in file:
+                if not line.startswith(('#', '@')):
+                    break
                 if 'xaxis  label "Time (ps)"' in line and args.x_conversion is None:
-                    args.x_conversion = 'ps to ns'    
-
-        # read in data starting from (m+1)-th line to the end
-        n = m   # line number
-        for line in lines[m:-1]:
-            n += 1
-            if '#' not in line and line[0] != '@':
-                # Note that when extending MetaD, COLVAR might append #! FIELDS ... 
-                x.append(float(line.split()[0]))
-                y.append(float(line.split()[args.column]))
-            elif '#' in line:  # the case the MetaD is extended
-                x = np.array(x)
-                x = x[x < float(lines[n].split()[0])]
-                x = list(x)
-                y = y[:len(x)]
-        x, y = np.array(x), np.array(y)
-
-        # Unit conversion
-        if args.xlabel is not None:
-            if '(' in args.xlabel:
-                if '$' in args.xlabel.split('(')[1]:
-                    x_unit = args.xlabel.split('$')[1].split('$')[0]
-                else:
-                    x_unit = args.xlabel.split('(')[1].split(')')[0]
-                x_var = args.xlabel.split('(')[0].lower()
-                if x_var[-1] == ' ':
-                    x_var = x_var.split(' ')[0].lower()
-            else:
-                x_unit = ''
-                x_var = args.xlabel.lower()
-        else:
-            x_unit = ''
-            x_var = None 
-
-        if args.ylabel is not None:
-            if '(' in args.ylabel:
-                if '$' in args.ylabel.split('(')[1]:
-                    y_unit = args.ylabel.split('$')[1].split('$')[0]
-                else:
-                    y_unit = args.ylabel.split('(')[1].split(')')[0]
-                y_var = args.ylabel.split('(')[0].lower()
-                if y_var[-1] == ' ':
-                    y_var = y_var.split(' ')[0].lower()
-            else:
-                y_unit = ''
-                y_var = args.ylabel.lower()
-        else:
-            y_unit = ''
-            y_var = None
+                    args.x_conversion = 'ps to ns'
 
-        x, x_unit = utils.apply_conversion(x, args.x_conversion, args.temp)
-        y, y_unit = utils.apply_conversion(y, args.y_conversion, args.temp)
+        # Fold the unit conversion and the user-specified factor into a single in-place multiplication
+        x_factor, x_unit = utils.get_conversion_factor(args.x_conversion, args.temp)
+        y_factor, y_unit = utils.get_conversion_factor(args.y_conversion, args.temp)
+        if x_unit is None:
+            x_unit = x_label_unit
+        if y_unit is None:
+            y_unit = y_label_unit
 
         if args.factor_x is not None:
-            x = x * args.factor_x
+            x_factor *= args.factor_x
         if args.factor_y is not None:
-            y = y * args.factor_y
+            y_factor *= args.factor_y
+
+        if x_factor != 1:
+            np.multiply(x, x_factor, out=x)
+        if y_factor != 1:
+            np.multiply(y, y_factor, out=y)
 
         if args.truncate is not None:
             y = y[int(0.01 * float(args.truncate) * len(y)):]
@@ -198,14 +209,14 @@ def main():
             x = x[:int(0.01 * float(args.retain) * len(x))]
             print(f"Retained only the first {args.retain}% of the data.")
         
-        y_avg = np.mean(y)
-        y2_avg = np.mean(np.power(y, 2))
+        # y @ y gives the sum of squares without allocating y ** 2, and the extrema are read off their indices
+        y_avg = y.sum() / y.size
+        y2_avg = (y @ y) / y.size
+        i_max, i_min = int(np.argmax(y)), int(np.argmin(y))
         RMSF = np.sqrt((y2_avg - y_avg ** 2)) / y_avg
-        print(f'The average of {y_var}: {y_avg:.3f} {y_unit} (RMSF: {RMSF:.3f} {y_unit} max: {np.max(y):.3f} {y_unit}, min: {np.min(y):.3f} {y_unit})')
-        if x_unit == ' ns' or x_unit == ' ps':
-            y = list(y)
-            print(f'The maximum occurs at {x[y.index(max(y))]:5.4f} {x_unit}, while the minimum occurs at {x[y.index(min(y))]:5.4f} {x_unit}.')
-            y = np.array(y)
+        print(f'The average of {y_var}: {y_avg:.3f} {y_unit} (RMSF: {RMSF:.3f} {y_unit} max: {y[i_max]:.3f} {y_unit}, min: {y[i_min]:.3f} {y_unit})')
+        if x_unit in ['ns', 'ps']:
+            print(f'The maximum occurs at {x[i_max]:5.4f} {x_unit}, while the minimum occurs at {x[i_min]:5.4f} {x_unit}.')
             diff = np.abs(y - y_avg)
             t_avg = x[np.argmin(diff)]
             print('The configuration at %s%s has the %s (%s%s) that is cloest to the average volume.' % (t_avg, x_unit, y_var, y[np.argmin(diff)], y_unit))
@@ -219,7 +230,7 @@ def main():
     plt.xlabel(args.xlabel)
     plt.ylabel(args.ylabel)
 
-    if max(abs(y)) >= 10000:
+    if np.max(np.abs(y)) >= 10000:
         plt.ticklabel_format(style='sci', axis='y', scilimits=(0, 0))
     
     plt.grid()
@@ -227,4 +238,4 @@ def main():
         if len(args.xvg) > 1:
             plt.legend(ncol=args.legend_col)
 
-    plt.savefig(args.figname, dpi=600)
+    utils.save_figure(fig, args.figname, 600)
@@ -1,17 +1,20 @@
 import os
 import sys
-import pymol
 import argparse
+import functools
+from useful_cli import utils
+from useful_cli.cli.visualize_pdb import render_image
 
 
-def initialize(args):
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     parser = argparse.ArgumentParser(
         description="This CLI visualises protein-ligand complexes using PyMOL. "
     )
     parser.add_argument(
         "-f",
         "--files",
-        type=str,
+        type=utils.input_file,
         nargs="+",
         required=True,
         help="List of files (that can be read by PyMOL) to visualize.",
@@ -21,7 +24,8 @@ def initialize(args):
         "--align",
         type=str,
         nargs="+",
-        help="The align commands to use. Note that the input structures files will be \
+        help="The align commands to use, e.g. 'align structure_2, structure_1'. The supported commands are \
+            align, super, cealign, alignto, pair_fit and fit. Note that the input structures files will be \
             automatically named as 'structure_1', 'structure_2', etc."
     )
     parser.add_argument(
@@ -37,25 +41,98 @@ def initialize(args):
         default="complex.png",
         help="The output file name.",
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "-q",
+        "--quality",
+        choices=["draft", "publication"],
+        default="draft",
+        help="The quality preset for ray tracing, either draft (no shadows, antialias 1) or publication \
+            (shadows, antialias 2, slower). Default is draft.",
+    )
+    ray = parser.add_mutually_exclusive_group()
+    ray.add_argument(
+        "--ray",
+        dest="ray",
+        default=None,
+        action="store_true",
+        help="Always ray trace the image. By default, images with at least 800 * 800 pixels are ray traced, \
+            which includes the 800x800 image rendered here.",
+    )
+    ray.add_argument(
+        "--no_ray",
+        dest="ray",
+        action="store_false",
+        help="Save the image directly from the OpenGL buffer instead of ray tracing it, which is much faster \
+            but gives lower image quality.",
+    )
+    return parser
+
+
+# The PyMOL commands that can be passed to --align
+_ALIGN_COMMANDS = ("align", "super", "cealign", "alignto", "pair_fit", "fit")
+
+
+def parse_align(align):
+    """
+    Parses an align command like "align structure_2, structure_1, cycles=0" into the
+    name of the command and its positional and keyword arguments.
+
+    Parameters
+    ----------
+    align : str
+        The align command.
+
+    Returns
+    -------
+    verb : str
+        The name of the command, which is one of :code:`_ALIGN_COMMANDS`.
+    align_args : list
+        The positional arguments of the command.
+    align_kwargs : dict
+        The keyword arguments of the command.
+    """
+    verb, _, rest = align.strip().partition(" ")
+    if verb not in _ALIGN_COMMANDS:
+        raise ValueError(
+            f"Unsupported align command '{verb}' in '{align}'. Supported commands are: {', '.join(_ALIGN_COMMANDS)}."
+        )
+    parts = [p.strip() for p in rest.split(",") if p.strip()]
+    align_args = [p for p in parts if "=" not in p]
+    align_kwargs = dict((s.strip() for s in p.split("=", 1)) for p in parts if "=" in p)
+
+    return verb, align_args, align_kwargs
+
+
+def initialize(args):
+    parser = _build_parser()
+    args = parser.parse_args(args)
+    if args.align:
+        # Check the align commands before PyMOL is started
+        try:
+            for align in args.align:
+                parse_align(align)
+        except ValueError as e:
+            parser.error(str(e))
     return args
 
 def main():
     args = initialize(sys.argv[1:])
-    cmd = pymol.cmd
+    from pymol import cmd, CmdException  # imported only after parsing so that --help stays fast
     for i, file in enumerate(args.files):
         cmd.load(file, f"structure_{i+1}")
 
     if args.align:
-        for i, align in enumerate(args.align):
-            align_obj = [i.strip() for i in align.split("align")[1].split(",")]
-            cmd.do(align)
+        for align in args.align:
+            # Call the command with its parsed arguments rather than having PyMOL parse it
+            verb, align_args, align_kwargs = parse_align(align)
+            try:
+                getattr(cmd, verb)(*align_args, **align_kwargs)
+            except CmdException:
+                # PyMOL has already printed the details of the error
+                sys.exit(f"Error: PyMOL failed to run the align command '{align}'.")
         cmd.orient()
         if args.zoom_obj:
             cmd.orient(args.zoom_obj)
             cmd.zoom(args.zoom_obj, buffer=5)
 
-    cmd.bg_color("white")
-    cmd.set("ray_opaque_background", "off")
-    cmd.ray()
-    cmd.png(args.output, width=800, height=800, dpi=600)
+    render_image(args.output, 800, 800, 600, args.ray, args.quality)
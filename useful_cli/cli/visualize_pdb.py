@@ -1,10 +1,13 @@
 import os
 import sys
 import time
-import pymol
 import argparse
+import functools
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from useful_cli import utils
 
-def initialize(args):
+@functools.lru_cache(maxsize=1)
+def _build_parser():
     parser = argparse.ArgumentParser(
         description="This CLI visualizes protein structures using PyMOL."
     )
@@ -12,14 +15,13 @@ def initialize(args):
         "-p",
         "--pdb_files",
         nargs="+",
-        type=str,
         required=True,
         help="The paths to the PDB files to visualize."
     )
     parser.add_argument(
         "-r",
         "--ref",
-        type=str,
+        type=utils.input_file,
         help="The path to the reference PDB file to align the input PDB files to."
     )
     parser.add_argument(
@@ -52,7 +54,8 @@ def initialize(args):
         "--dpi",
         type=int,
         default=600,
-        help="The DPI of the output image. Default is 600."
+        help="The DPI of the output image. Default is 600. Note that this only sets the resolution stored in \
+            the PNG file. The number of pixels, and therefore the rendering cost, is set by --width and --height."
     )
     parser.add_argument(
         "-a",
@@ -91,10 +94,50 @@ def initialize(args):
         type=float,
         help="The buffer (in Angstroms) around the selected atoms to zoom in on. The default is not to zoom in at all."
     )
-    args = parser.parse_args()
+    parser.add_argument(
+        "-q",
+        "--quality",
+        choices=["draft", "publication"],
+        default="draft",
+        help="The quality preset for ray tracing. The draft preset turns off shadows and uses a single level \
+            of antialiasing, while the publication preset turns on shadows and uses two levels of antialiasing, \
+            which is considerably slower. Default is draft."
+    )
+    ray = parser.add_mutually_exclusive_group()
+    ray.add_argument(
+        "--ray",
+        dest="ray",
+        default=None,
+        action="store_true",
+        help="Always ray trace the image. By default, only images with at least 800 * 800 pixels are \
+            ray traced, while smaller ones are saved directly from the OpenGL buffer."
+    )
+    ray.add_argument(
+        "--no_ray",
+        dest="ray",
+        action="store_false",
+        help="Never ray trace the image but save it directly from the OpenGL buffer, which is much faster \
+            but gives lower image quality."
+    )
+    return parser
+
+
+def initialize(args):
+    parser = _build_parser()
+    args = parser.parse_args(args)
+    if args.align_all and args.ref is None:
+        parser.error("The --align_all flag requires a reference PDB file to be provided with the -r flag.")
+
+    # The input files are checked concurrently since each check is a round trip on a network file system
+    with ThreadPoolExecutor(max_workers=min(len(args.pdb_files), 32)) as executor:
+        readable = executor.map(utils.is_readable_file, args.pdb_files)
+        missing = [path for path, ok in zip(args.pdb_files, readable) if not ok]
+    if missing:
+        parser.error(f"The following PDB files do not exist or are not readable: {', '.join(missing)}")
     return args
 
-def load_and_align(obj_name, pdb_file, ref=None, split=False, n_models=None, selection=None, zoom=None):
+def load_and_align(obj_name, pdb_file, ref=None, split=False, n_models=None, selection=None, zoom=None, cmd=None,
+                   ref_obj=None, do_orient=True):
     """
     Load a PDB file into PyMOL and align it to a reference structure (if provided).
 
@@ -117,35 +160,60 @@ def load_and_align(obj_name, pdb_file, ref=None, split=False, n_models=None, sel
         The selection of atoms to align and visualize. If not provided, all atoms will be used.
     zoom : float, optional
         The buffer (in Angstroms) around the selected atoms to zoom in on. The default is not to zoom in at all.
+    cmd : module, optional
+        The PyMOL command API to use, e.g. :code:`cmd` of a :code:`pymol2.PyMOL` instance.
+        The default is :code:`pymol.cmd`.
+    ref_obj : str, optional
+        Name of a reference structure that has already been loaded into PyMOL. If provided, the input
+        PDB file will be aligned to this object and :code:`ref` will not be loaded again.
+    do_orient : bool, optional
+        Whether to orient (and zoom, if :code:`zoom` is specified) the view after loading. When several
+        structures are loaded into the same scene, only the last call needs to do this. The default is True.
     """
     print(f"Loading {pdb_file}...")
-    cmd = pymol.cmd
+    if cmd is None:
+        from pymol import cmd
     cmd.load(pdb_file, obj_name)
     
     align_obj = obj_name
     if selection is not None:
         obj_name = f"{obj_name}_selected"
-        cmd.select(obj_name, selection)
+        cmd.select(obj_name, f"{align_obj} and ({selection})")
         if cmd.count_atoms(obj_name) == 0:
             raise ValueError(f"The selection {selection} does not contain any atoms.")
-        cmd.hide("everything", f"not {obj_name}")
+        cmd.hide("everything", f"{align_obj} and not {obj_name}")
+
+    if ref_obj is None and ref is not None:
+        ref_obj = "reference"
+        cmd.load(ref, ref_obj)
 
     if split:
-        print("Splitting the models...")
-        cmd.split_states(obj_name)
+        total_states = cmd.count_states(obj_name)
         if n_models is None:
-            n_models = cmd.count_states(obj_name)
+            n_models = total_states
         else:
-            if n_models > cmd.count_states(obj_name):
-                raise ValueError(f"The input PDB file {pdb_file} contains only {cmd.count_states(obj_name)} models \
+            if n_models > total_states:
+                raise ValueError(f"The input PDB file {pdb_file} contains only {total_states} models \
                     but n_models is set to {n_models}.")
 
-        if ref is not None:
-            cmd.load(ref, "reference")
+        # All models share the same atoms, so unless they have to be aligned to a reference or using
+        # a selection, they can all be fitted to the first model in one call before being split. Since
+        # intra_fit fits every state, this is only done if all the models are visualized. Note that unlike
+        # cmd.align, intra_fit fits all atoms without rejecting outliers.
+        fit_states = ref_obj is None and selection is None and n_models == total_states
+        if fit_states:
+            print(f"Fitting all models of {align_obj} to the first model...")
+            cmd.intra_fit(obj_name, 1)
+
+        # Only the models to be visualized are split into separate objects
+        print("Splitting the models...")
+        cmd.split_states(obj_name, first=1, last=n_models)
+
+        if ref_obj is not None:
             for i in range(1, n_models + 1):
                 print(f"Aligning {align_obj}_{i:04d} to the reference...")
-                cmd.align(f"{align_obj}_{i:04d}", "reference")
-        else:
+                cmd.align(f"{align_obj}_{i:04d}", ref_obj)
+        elif not fit_states:
             for i in range(2, n_models + 1):
                 print(f"Aligning {align_obj}_{i:04d} to {align_obj}_0001...")
                 cmd.align(f"{align_obj}_{i:04d}", f"{align_obj}_0001")
@@ -155,18 +223,19 @@ def load_and_align(obj_name, pdb_file, ref=None, split=False, n_models=None, sel
         # cmd.spectrum("count", "green_white_yellow", f"{obj_name}_*")
         
     else:
-        if ref is not None:
-            cmd.load(ref, "reference")
-            cmd.align(obj_name, "reference")
+        if ref_obj is not None:
+            cmd.align(obj_name, ref_obj)
 
-    cmd.orient()
-    if zoom is not None:
-        cmd.zoom(obj_name, buffer=zoom)
+    if do_orient:
+        cmd.orient()
+        if zoom is not None:
+            cmd.zoom(obj_name, buffer=zoom)
 
 
-def render_image(output, width, height, dpi):
+def render_image(output, width, height, dpi, ray=None, quality="draft", cmd=None):
     """
-    Render the current PyMOL scene and save it as a PNG image.
+    Render the current PyMOL scene and save it as a PNG image, either ray traced
+    or directly from the OpenGL buffer.
 
     Parameters
     ----------
@@ -178,70 +247,140 @@ def render_image(output, width, height, dpi):
         Height of the output image in pixels.
     dpi : int
         DPI (dots per inch) of the output image.
+    ray : bool, optional
+        Whether to ray trace the image. If not specified, the image is ray traced only if
+        width * height is at least 800 * 800. The DPI only sets the metadata of the PNG file, so it
+        does not affect the cost and is not taken into account.
+    quality : str, optional
+        The quality preset, either "draft" (no shadows, antialias 1) or "publication"
+        (shadows, antialias 2). The default is "draft".
+    cmd : module, optional
+        The PyMOL command API to use, e.g. :code:`cmd` of a :code:`pymol2.PyMOL` instance.
+        The default is :code:`pymol.cmd`.
     """
-    cmd = pymol.cmd
+    if cmd is None:
+        from pymol import cmd
     cmd.bg_color("white")
     cmd.set("ray_opaque_background", "off")
-    cmd.ray()
-    cmd.png(output, width=width, height=height, dpi=dpi)
+    if quality == "publication":
+        cmd.set("antialias", 2)
+        cmd.set("ray_shadows", 1)
+    else:
+        cmd.set("antialias", 1)
+        cmd.set("ray_shadows", 0)
+    if ray is None:
+        ray = width * height >= 800 * 800
+    if ray:
+        # Ray trace at the output size so that cmd.png saves this image instead of tracing again
+        cmd.ray(width, height)
+        cmd.png(output, dpi=dpi)
+    else:
+        cmd.png(output, width=width, height=height, dpi=dpi, ray=0)
+
+
+_session = None  # The PyMOL instance of a worker process
+
+
+def _init_worker(ref):
+    """
+    Starts the PyMOL instance of a worker process and loads the reference structure (if any)
+    into it, so that the reference is parsed once per worker rather than once per PDB file.
+    """
+    import pymol2
+
+    global _session
+    _session = pymol2.PyMOL()
+    _session.start()
+    if ref is not None:
+        _session.cmd.load(ref, "reference")
+
+
+def _render_one(pdb_file, output, ref, split, n_models, selection, zoom, width, height, dpi, ray, quality):
+    """
+    Loads, aligns and renders a single PDB file in the PyMOL instance of the worker process,
+    then deletes the objects created for it while keeping the reference.
+    """
+    cmd = _session.cmd
+    load_and_align(
+        "structure",
+        pdb_file,
+        split=split,
+        n_models=n_models,
+        selection=selection,
+        zoom=zoom,
+        cmd=cmd,
+        ref_obj="reference" if ref else None
+    )
+    render_image(output, width, height, dpi, ray, quality, cmd=cmd)
+    cmd.delete("structure")
+    cmd.delete("structure_*")
 
 
 def main():
     t0 = time.time()
     args = initialize(sys.argv[1:])
 
-    # 1. Check input arguments
-    for pdb_file in args.pdb_files:
-        if not os.path.exists(pdb_file):
-            raise FileNotFoundError(f"The file {pdb_file} does not exist.")
-    if args.ref is not None and not os.path.exists(args.ref):
-        raise FileNotFoundError(f"The file {args.ref} does not exist.")
+    # 1. Check input arguments (the existence of the input files and the reference required
+    # by --align_all are checked in initialize)
     if args.align_all:
-        if args.ref is None:
-            raise ValueError("The --align_all flag requires a reference PDB file to be provided with the -r flag.")
+        if args.outputs is not None:
+            if len(args.outputs) != 1:
+                raise ValueError("The --align_all flag requires a single output file to be provided.")
         else:
-            if args.outputs is not None:
-                if len(args.outputs) != 1:
-                    raise ValueError("The --align_all flag requires a single output file to be provided.")
-            else:
-                args.outputs = ["aligned_structures.png"]
+            args.outputs = ["aligned_structures.png"]
     else:
         if args.outputs is not None:
             if len(args.outputs) != len(args.pdb_files):
                 raise ValueError("The number of output files must match the number of input PDB files.")
         else:
-            args.outputs = [pdb_file.split(".")[0] + ".png" for pdb_file in args.pdb_files]
+            args.outputs = [os.path.splitext(pdb_file)[0] + ".png" for pdb_file in args.pdb_files]
 
-    # 2. Load, align and save structures
-    cmd = pymol.cmd
+    # 2. Load, align and save structures (PyMOL is imported only here so that --help stays fast)
     if args.align_all:
-        if args.ref:
-            cmd.load(args.ref, "reference")
+        from pymol import cmd
+        cmd.load(args.ref, "reference")
         for i, pdb_file in enumerate(args.pdb_files):
             load_and_align(
                 f"structure_{i}",
                 pdb_file,
-                "reference" if args.ref else None,
-                args.split,
-                args.n_models,
-                args.selection,
-                args.zoom
+                split=args.split,
+                n_models=args.n_models,
+                selection=args.selection,
+                zoom=args.zoom,
+                ref_obj="reference",
+                do_orient=(i == len(args.pdb_files) - 1)  # only the view of the last one is kept
             )
 
         print("Rendering the image...")
-        render_image(args.outputs[0], args.width, args.height, args.dpi)
+        render_image(args.outputs[0], args.width, args.height, args.dpi, args.ray, args.quality)
     else:
-        for pdb_file, output in zip(args.pdb_files, args.outputs):
-            load_and_align(
-                "structure",
-                pdb_file,
-                args.ref,
-                args.split,
-                args.n_models,
-                args.selection,
-                args.zoom
-            )
-            render_image(output, args.width, args.height, args.dpi)
-            cmd.delete("all")
+        # Ray tracing dominates the cost and the PDB files are independent of each other,
+        # so they are rendered in worker processes, each with its own PyMOL instance.
+        render_one = functools.partial(
+            _render_one,
+            ref=args.ref,
+            split=args.split,
+            n_models=args.n_models,
+            selection=args.selection,
+            zoom=args.zoom,
+            width=args.width,
+            height=args.height,
+            dpi=args.dpi,
+            ray=args.ray,
+            quality=args.quality
+        )
+        n_workers = min(len(args.pdb_files), os.cpu_count() or 1)
+        if n_workers == 1:
+            # Nothing to parallelize, so spare the cost of starting a worker process
+            _init_worker(args.ref)
+            for pdb_file, output in zip(args.pdb_files, args.outputs):
+                render_one(pdb_file, output)
+        else:
+            with ProcessPoolExecutor(
+                max_workers=n_workers,
+                initializer=_init_worker,
+                initargs=(args.ref,)
+            ) as executor:
+                list(executor.map(render_one, args.pdb_files, args.outputs))
 
     print(f"Elapsed time: {time.time() - t0:.2f} s.")
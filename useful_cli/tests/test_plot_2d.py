@@ -0,0 +1,24 @@
+"""
+Unit tests for the module plot_2d.py.
+"""
+from useful_cli.cli import plot_2d
+
+
+def test_initialize():
+    args = plot_2d.initialize(['-f', 'a.xvg', 'b.xvg', '-c', '2'])
+    assert args.xvg == ['a.xvg', 'b.xvg']
+    assert args.legend == ['a.xvg', 'b.xvg']
+    assert args.column == 2
+
+    # The parser is built once and reused
+    assert plot_2d._build_parser() is plot_2d._build_parser()
+    args = plot_2d.initialize(['-f', 'c.xvg', '-l', 'c'])
+    assert args.legend == ['c']
+    assert args.column == 1
+
+
+def test_parse_label():
+    assert plot_2d.parse_label(None) == (None, '')
+    assert plot_2d.parse_label('Time (ns)') == ('time', 'ns')
+    assert plot_2d.parse_label('Energy ($k_BT$)') == ('energy', 'k_BT')
+    assert plot_2d.parse_label('RMSD') == ('rmsd', '')
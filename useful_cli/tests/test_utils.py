@@ -0,0 +1,178 @@
+"""
+Unit tests for the module utils.py.
+"""
+import os
+import argparse
+
+import numpy as np
+import pytest
+
+from useful_cli import utils
+
+
+def test_read_xvg(tmp_path):
+    xvg = tmp_path / 'test.xvg'
+    xvg.write_text(
+        '# GROMACS header\n'
+        '@    xaxis  label "Time (ps)"\n'
+        '@ s0 legend "a"\n'
+        '0 1.0 10.0\n'
+        '1 2.0 20.0\n'
+        '2 3.0 30.0\n'
+    )
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [0, 1, 2])
+    np.testing.assert_array_equal(y, [1.0, 2.0, 3.0])
+
+    x, y = utils.read_xvg(str(xvg), column=2)
+    np.testing.assert_array_equal(y, [10.0, 20.0, 30.0])
+
+
+def test_read_xvg_extended_metad(tmp_path):
+    # PLUMED appends a new header when a MetaD simulation is extended from an earlier time
+    xvg = tmp_path / 'COLVAR'
+    xvg.write_text(
+        '#! FIELDS time d1\n'
+        '0 0.0\n1 0.1\n2 0.2\n3 0.3\n'
+        '#! FIELDS time d1\n'
+        '2 0.5\n3 0.6\n4 0.7\n'
+    )
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [0, 1, 2, 3, 4])
+    np.testing.assert_array_equal(y, [0.0, 0.1, 0.5, 0.6, 0.7])
+
+
+def test_read_xvg_extended_metad_multiple(tmp_path):
+    xvg = tmp_path / 'COLVAR'
+    xvg.write_text(
+        '#! FIELDS time d1\n'
+        '0 0.0\n1 0.1\n2 0.2\n3 0.3\n4 0.4\n'
+        '#! FIELDS time d1\n'
+        '3 1.3\n4 1.4\n5 1.5\n'
+        '#! FIELDS time d1\n'
+        '1 2.1\n2 2.2\n'
+    )
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [0, 1, 2])
+    np.testing.assert_array_equal(y, [0.0, 2.1, 2.2])
+
+
+def test_read_xvg_partial_last_line(tmp_path):
+    # The last row of a file that is still being written may be incomplete
+    xvg = tmp_path / 'COLVAR'
+    xvg.write_text('#! FIELDS time d1 d2\n0 0.0 1.0\n1 0.1 1.1\n2 0.2')
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [0, 1])
+    np.testing.assert_array_equal(y, [0.0, 0.1])
+
+
+def test_read_xvg_non_increasing(tmp_path):
+    # Without a restart, the data is kept even if the x values are not strictly increasing
+    xvg = tmp_path / 'test.xvg'
+    xvg.write_text('@ s0 legend "a"\n3 0.3\n2 0.2\n1 0.1\n')
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [3, 2, 1])
+    np.testing.assert_array_equal(y, [0.3, 0.2, 0.1])
+
+    xvg.write_text('0 0.0\n1 0.1\n1 0.2\n2 0.3\n')
+    x, y = utils.read_xvg(str(xvg))
+    np.testing.assert_array_equal(x, [0, 1, 1, 2])
+    np.testing.assert_array_equal(y, [0.0, 0.1, 0.2, 0.3])
+
+
+def test_get_conversion_factor():
+    assert utils.get_conversion_factor() == (1.0, None)
+    assert utils.get_conversion_factor('ps to ns') == (0.001, 'ns')
+    for conversion in utils.get_conversions():
+        factor, unit = utils.get_conversion_factor(conversion, 300)
+        data, unit_ref = utils.apply_conversion(np.array([1.0, 2.0]), conversion, 300)
+        np.testing.assert_allclose(np.array([1.0, 2.0]) * factor, data)
+        assert unit == unit_ref
+
+
+def test_read_xvg_cache(tmp_path):
+    xvg = tmp_path / 'test.xvg'
+    xvg.write_text('@ s0 legend "a"\n0 1.0\n1 2.0\n')
+    x, y = utils.read_xvg(str(xvg), cache=True)
+    npz = tmp_path / 'test.xvg.c1.npz'
+    assert npz.exists()
+
+    x_cached, y_cached = utils.read_xvg(str(xvg), cache=True)
+    np.testing.assert_array_equal(x_cached, x)
+    np.testing.assert_array_equal(y_cached, y)
+
+    # A replaced XVG file with an older modification time (e.g. from cp -p) is parsed again
+    mtime_ns = os.stat(xvg).st_mtime_ns
+    xvg.write_text('@ s0 legend "a"\n0 3.0\n1 4.0\n')
+    os.utime(xvg, ns=(mtime_ns - 10 ** 9, mtime_ns - 10 ** 9))
+    x, y = utils.read_xvg(str(xvg), cache=True)
+    np.testing.assert_array_equal(y, [3.0, 4.0])
+
+
+def test_read_xvg_corrupt_cache(tmp_path):
+    xvg = tmp_path / 'test.xvg'
+    xvg.write_text('@ s0 legend "a"\n0 1.0\n1 2.0\n')
+    utils.read_xvg(str(xvg), cache=True)
+    npz = tmp_path / 'test.xvg.c1.npz'
+
+    # A truncated or empty sidecar file is parsed again and replaced
+    for size in [npz.stat().st_size // 2, 0]:
+        with open(npz, 'r+b') as f:
+            f.truncate(size)
+        x, y = utils.read_xvg(str(xvg), cache=True)
+        np.testing.assert_array_equal(x, [0, 1])
+        np.testing.assert_array_equal(y, [1.0, 2.0])
+        x, y = utils.read_xvg(str(xvg), cache=True)
+        np.testing.assert_array_equal(y, [1.0, 2.0])
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['test.xvg', 'test.xvg.c1.npz']
+
+
+def test_apply_conversion():
+    data, unit = utils.apply_conversion([1000.0, 2000.0], 'ps to ns')
+    np.testing.assert_allclose(data, [1.0, 2.0])
+    assert unit == 'ns'
+
+    data = np.array([1.0, 2.0])
+    out, unit = utils.apply_conversion(data, 'kT to kJ/mol', 300, out=data)
+    assert out is data
+    np.testing.assert_allclose(data, np.array([1.0, 2.0]) * 1.38064852 * 6.02 * 300 / 1000)
+    assert unit == 'kJ/mol'
+
+    data, unit = utils.apply_conversion(data)
+    assert unit is None
+
+
+def test_input_file(tmp_path):
+    path = tmp_path / 'test.pdb'
+    path.write_text('END\n')
+    assert utils.input_file(str(path)) == str(path)
+    assert utils.is_readable_file(str(path))
+    assert not utils.is_readable_file(str(tmp_path))
+    assert not utils.is_readable_file(str(tmp_path / 'missing.pdb'))
+    with pytest.raises(argparse.ArgumentTypeError):
+        utils.input_file(str(tmp_path / 'missing.pdb'))
+
+
+def test_get_subplot_layout():
+    layouts = {1: (1, 1), 2: (2, 1), 3: (2, 2), 4: (2, 2), 5: (3, 2), 7: (3, 3), 9: (3, 3), 10: (4, 3)}
+    for n_subplots, layout in layouts.items():
+        assert utils.get_subplot_layout(n_subplots) == layout
+
+
+def test_save_figure(tmp_path):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig = plt.figure(figsize=(2, 1))
+    for figname in ['fig.png', 'fig.jpg']:
+        utils.save_figure(fig, str(tmp_path / figname), 100)
+        assert (tmp_path / figname).exists()
+        with pytest.raises(OSError):
+            utils.save_figure(fig, str(tmp_path / 'missing' / figname), 100)
+
+    # The DPI is stored in the JFIF header of JPEG files
+    data = (tmp_path / 'fig.jpg').read_bytes()
+    assert data[6:11] == b'JFIF\0'
+    assert data[13] == 1 and data[14:18] == b'\x00\x64\x00\x64'
+    plt.close(fig)
@@ -0,0 +1,17 @@
+"""
+Unit tests for the module visualize_complex.py.
+"""
+import pytest
+
+from useful_cli.cli import visualize_complex
+
+
+def test_parse_align():
+    assert visualize_complex.parse_align("align structure_2, structure_1") == (
+        "align", ["structure_2", "structure_1"], {}
+    )
+    assert visualize_complex.parse_align("cealign structure_1,structure_2, window = 8") == (
+        "cealign", ["structure_1", "structure_2"], {"window": "8"}
+    )
+    with pytest.raises(ValueError):
+        visualize_complex.parse_align("delete all")
@@ -1,9 +1,59 @@
 
-import matplotlib.pyplot as plt
-from matplotlib import rc
+import io
+import os
+import math
+import mmap
+import struct
+import argparse
+import zipfile
+import tempfile
+import functools
+import numpy as np
+
+
+def is_readable_file(path):
+    """
+    Checks whether a path is an existing file that is readable.
+
+    Parameters
+    ----------
+    path : str
+        The path to check.
+
+    Returns
+    -------
+    readable : bool
+        Whether the path is an existing and readable file.
+    """
+    return os.path.isfile(path) and os.access(path, os.R_OK)
+
+
+def input_file(path):
+    """
+    Checks that the input file exists and is readable. This is meant to be used as the :code:`type`
+    of an argparse argument so that a wrong path is reported before any expensive setup.
+
+    Parameters
+    ----------
+    path : str
+        The path to the input file.
+
+    Returns
+    -------
+    path : str
+        The same path, if the file exists and is readable.
+    """
+    if not is_readable_file(path):
+        reason = "is not readable" if os.path.isfile(path) else "does not exist"
+        raise argparse.ArgumentTypeError(f"The file {path} {reason}.")
+
+    return path
 
 
 def configure_matplotlib():
+    import matplotlib.pyplot as plt
+    from matplotlib import rc
+
     rc('font', **{
        'family': 'sans-serif',
        'sans-serif': ['DejaVu Sans'],
@@ -14,41 +64,167 @@ def configure_matplotlib():
     plt.rc('font', family='serif')
 
 
+# Boltzmann constant times Avogadro's number (kJ/mol/K or kcal/mol/K), i.e. kT = _KB_NA_KJ * temp
+_KB_NA_KJ = 1.38064852 * 6.02 / 1000
+_KCAL_PER_KJ = 0.239005736
+_KB_NA_KCAL = _KB_NA_KJ * _KCAL_PER_KJ
+_RAD_PER_DEG = np.pi / 180
+
+
+@functools.lru_cache(maxsize=1)
 def get_conversions():
     """
     Returns a dictionary mapping conversion keys to a tuple of
     (conversion_function, target_unit_label).
     The conversion_function may require the temperature value as a parameter.
+    The dictionary is built once and cached, so it should not be modified.
     """
     return {
         'ps to ns': (lambda x, temp=None: x / 1000, 'ns'),
         'ns to ps': (lambda x, temp=None: x * 1000, 'ps'),
-        'kT to kJ/mol': (lambda x, temp: x * (1.38064852 * 6.02 * temp / 1000), 'kJ/mol'),
-        'kJ/mol to kT': (lambda x, temp: x / (1.38064852 * 6.02 * temp / 1000), 'kT'),
-        'kT to kcal/mol': (lambda x, temp: x * (1.38064852 * 6.02 * temp / 1000) * 0.239005736, 'kcal/mol'),
-        'kcal/mol to kT': (lambda x, temp: x / ((1.38064852 * 6.02 * temp / 1000) * 0.239005736), 'kT'),
-        'kJ/mol to kcal/mol': (lambda x, temp=None: x * 0.239005736, 'kcal/mol'),
-        'kcal/mol to kJ/mol': (lambda x, temp=None: x / 0.239005736, 'kJ/mol'),
-        'degree to radian': (lambda x, temp=None: x * (np.pi / 180), 'radian'),
-        'radian to degree': (lambda x, temp=None: x / (np.pi / 180), 'degree')
+        'kT to kJ/mol': (lambda x, temp: x * (_KB_NA_KJ * temp), 'kJ/mol'),
+        'kJ/mol to kT': (lambda x, temp: x / (_KB_NA_KJ * temp), 'kT'),
+        'kT to kcal/mol': (lambda x, temp: x * (_KB_NA_KCAL * temp), 'kcal/mol'),
+        'kcal/mol to kT': (lambda x, temp: x / (_KB_NA_KCAL * temp), 'kT'),
+        'kJ/mol to kcal/mol': (lambda x, temp=None: x * _KCAL_PER_KJ, 'kcal/mol'),
+        'kcal/mol to kJ/mol': (lambda x, temp=None: x / _KCAL_PER_KJ, 'kJ/mol'),
+        'degree to radian': (lambda x, temp=None: x * _RAD_PER_DEG, 'radian'),
+        'radian to degree': (lambda x, temp=None: x / _RAD_PER_DEG, 'degree')
     }
 
 
-def apply_conversion(data, conversion=None, temp=None):
+def apply_conversion(data, conversion=None, temp=None, out=None):
     """
     Apply unit conversion on data if conversion is specified.
     The conversion parameter should be one of the keys in the dictionary returned by get_conversions().
+    The data is converted to a NumPy array and scaled with a single vectorized multiplication. If out
+    is specified (e.g. the data array itself), the result is written to it without allocating a new array.
     """
-    if conversion is None:
+    data = np.asarray(data)
+    factor, unit_label = get_conversion_factor(conversion, temp)
+    if conversion is None and out is None:
         return data, None
-    conversions = get_conversions()
-    func, unit_label = conversions[conversion]
+
+    return np.multiply(data, factor, out=out), unit_label
+
+
+def get_conversion_factor(conversion=None, temp=None):
+    """
+    Returns the multiplicative factor of a unit conversion. All the conversions returned by
+    get_conversions() are linear, so the factor is simply the converted value of 1.
+
+    Parameters
+    ----------
+    conversion : str, optional
+        One of the keys in the dictionary returned by get_conversions(). If not specified,
+        the factor is 1.
+    temp : float, optional
+        The temperature, which is required by the conversions involving kT.
+
+    Returns
+    -------
+    factor : float
+        The factor to multiply the data by.
+    unit_label : str or None
+        The unit after the conversion. None if no conversion is specified.
+    """
+    if conversion is None:
+        return 1.0, None
+    func, unit_label = get_conversions()[conversion]
 
     try:
-        new_data = func(data, temp)
+        factor = func(1.0, temp)
     except TypeError:
-        new_data = func(data)
-    return new_data, unit_label
+        factor = func(1.0)
+    return factor, unit_label
+
+
+def read_xvg(xvg, column=1, cache=False):
+    """
+    Reads the x values (the first column) and the y values (the specified column) from an XVG file.
+    Lines starting with :code:`#` or :code:`@` are skipped. When the x values restart, which happens
+    when a MetaD simulation is extended and PLUMED appends to the existing COLVAR file, the data points
+    from the previous run at and beyond the restart point are discarded. A last line that does not end
+    with a newline is ignored, since it may be incomplete if the file is still being written.
+
+    If :code:`cache` is True, the parsed data is saved to a sidecar file :code:`{xvg}.c{column}.npz`
+    along with the size and the modification time (in nanoseconds) of the XVG file. In later calls,
+    the sidecar file is loaded instead of the XVG file as long as both of them still match exactly.
+
+    Parameters
+    ----------
+    xvg : str
+        The path to the XVG file.
+    column : int, optional
+        The index of the column to read as the y values. The default is 1.
+    cache : bool, optional
+        Whether to cache the parsed data in a sidecar NPZ file. The default is False.
+
+    Returns
+    -------
+    x : np.ndarray
+        The x values.
+    y : np.ndarray
+        The y values.
+    """
+    npz = f'{xvg}.c{column}.npz'
+    stat = os.stat(xvg)
+    if cache and os.path.exists(npz):
+        # A sidecar file that cannot be read (e.g. a truncated one) is treated as a cache miss
+        try:
+            with np.load(npz) as cached:
+                if cached['size'] == stat.st_size and cached['mtime_ns'] == stat.st_mtime_ns:
+                    return cached['x'], cached['y']
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            pass
+
+    # Locate the end of the header with a scan over a memory map, which also finds out whether there
+    # are comment lines within the data (e.g. from an extended MetaD simulation). If there are none,
+    # np.loadtxt can skip the header by line count and parse the rest without looking for comments,
+    # which is several times faster for large files.
+    # If the file does not end with a newline, its last line may be a partial row of a file
+    # that is still being written (e.g. the COLVAR file of a running simulation), so it is left out.
+    n_header, comments, restarted = 0, None, False
+    source = xvg
+    if stat.st_size > 0:
+        with open(xvg, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = 0
+            while buf[start:start + 1] in (b'#', b'@'):
+                n_header += 1
+                start = buf.find(b'\n', start) + 1 or len(buf)
+            restarted = buf.find(b'#', start) != -1  # e.g. "#! FIELDS" appended by PLUMED
+            if restarted or buf.find(b'@', start) != -1:
+                comments = ('#', '@')
+            if buf[-1:] != b'\n':
+                source = io.BytesIO(buf[:buf.rfind(b'\n') + 1])
+
+    data = np.loadtxt(source, comments=comments, skiprows=n_header, usecols=(0, column), ndmin=2)
+    x, y = data[:, 0], data[:, 1]
+
+    # If the simulation was restarted, a data point is kept only if it precedes all later x values, i.e. it
+    # is smaller than the minimum of the remaining x values. This drops the overlap before every restart in
+    # one pass. Data without a restart is returned as is, even if the x values are not increasing.
+    if restarted and np.any(np.diff(x) <= 0):
+        suffix_min = np.minimum.accumulate(x[::-1])[::-1]
+        keep = np.append(x[:-1] < suffix_min[1:], True)
+        x, y = x[keep], y[keep]
+
+    if cache:
+        # The sidecar file is written to a temporary file first and then renamed, so that an interrupted
+        # write or two concurrent writers never leave a partial sidecar file behind.
+        tmp = None
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npz', prefix=f'.{os.path.basename(npz)}.',
+                                       dir=os.path.dirname(npz) or '.')
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, x=x, y=y, size=np.int64(stat.st_size), mtime_ns=np.int64(stat.st_mtime_ns))
+            os.replace(tmp, npz)
+        except OSError:
+            # e.g. the directory of the XVG file is read-only or the disk is full
+            if tmp is not None and os.path.exists(tmp):
+                os.remove(tmp)
+
+    return x, y
 
 
 def get_subplot_layout(n_subplots):
@@ -63,21 +239,54 @@ def get_subplot_layout(n_subplots):
 
     Returns
     -------
-    n_rows : int
-        The number of rows in the figure.
     n_cols : int
         The number of columns in the figure.
+    n_rows : int
+        The number of rows in the figure.
     """
-    if int(np.sqrt(n_subplots) + 0.5) ** 2 == n_subplots:
-        # perfect square number
-        n_cols = int(np.sqrt(n_subplots))
-    else:
-        n_cols = int(np.floor(np.sqrt(n_subplots))) + 1 
-    
-    if n_subplots % n_cols == 0:
-        n_rows = int(n_subplots / n_cols)
-    else:
-        n_rows = int(np.floor(n_subplots / n_cols)) + 1 
-    
+    s = math.isqrt(n_subplots)
+    n_cols = s if s * s == n_subplots else s + 1  # perfect square number or not
+    n_rows = -(-n_subplots // n_cols)  # ceiling division
+
     return n_cols, n_rows
 
+
+def save_figure(fig, figname, dpi):
+    """
+    Saves a figure. JPEG outputs are rendered once to an RGBA buffer with the Agg renderer and
+    encoded with OpenCV (libjpeg-turbo), which is faster than going through :code:`savefig`.
+    The DPI is written to the JFIF header, as :code:`savefig` would do. Any other format,
+    including PNG, is saved with :code:`savefig`, since encoding the PNG with OpenCV at a
+    comparable file size is no faster and drops the alpha channel and the DPI metadata.
+
+    Parameters
+    ----------
+    fig : matplotlib.figure.Figure
+        The figure to save.
+    figname : str
+        The path to save the figure.
+    dpi : float
+        The resolution of the saved figure in dots per inch.
+    """
+    ext = os.path.splitext(figname)[1].lower()
+    if ext not in ['.jpg', '.jpeg']:
+        fig.savefig(figname, dpi=dpi)
+        return
+
+    import cv2
+
+    fig.set_dpi(dpi)
+    fig.canvas.draw()
+    buf = np.asarray(fig.canvas.buffer_rgba())
+    ok, encoded = cv2.imencode('.jpg', cv2.cvtColor(buf, cv2.COLOR_RGBA2BGR), [cv2.IMWRITE_JPEG_QUALITY, 95])
+    if not ok:
+        raise OSError(f'Failed to encode the figure for {figname}.')
+    encoded = bytearray(encoded.tobytes())
+
+    # Set the density of the JFIF APP0 segment (right after the SOI marker) to the DPI
+    if encoded[6:11] == b'JFIF\0':
+        encoded[13] = 1  # units: dots per inch
+        encoded[14:18] = struct.pack('>HH', round(dpi), round(dpi))
+
+    with open(figname, 'wb') as f:
+        f.write(encoded)